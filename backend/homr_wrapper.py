@@ -1,14 +1,69 @@
+import io
+import hashlib
 import os
+import platform
+import re
 import tempfile
 import shutil
 from pathlib import Path
+from contextlib import contextmanager
 from typing import Tuple, List
 from fractions import Fraction
+from collections import OrderedDict
+from xml.sax.saxutils import XMLGenerator
 
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory file locks, run unlocked
+    fcntl = None
+
+import cv2
+import numpy as np
 import onnxruntime as ort
+from lxml import etree as ET
+import homr
 from homr.main import process_image, ProcessingConfig, download_weights
 from homr.music_xml_generator import XmlGeneratorArguments
+from homr.segmentation.config import segnet_path_onnx, segnet_path_onnx_fp16
+from homr.transformer.configs import default_config
 import homr.music_xml_generator as _xmlgen
+import homr.debug as _debug
+
+# Precompiled patterns for scanning generated MusicXML
+_PER_MINUTE_RE = re.compile(r'<per-minute>(\d+)</per-minute>')
+_SOUND_TEMPO_RE = re.compile(r'<sound[^>]*tempo="(\d+)"')
+_PART_RE = re.compile(r'<part id="([^"]+)"')
+_STAVES_RE = re.compile(r'<staves>(\d+)</staves>')
+_BEATS_RE = re.compile(r'<beats>(\d+)</beats>')
+_BEAT_TYPE_RE = re.compile(r'<beat-type>(\d+)</beat-type>')
+_FIFTHS_RE = re.compile(r'<fifths>(-?\d+)</fifths>')
+_WORDS_RE = re.compile(r'<words[^>]*>([^<]+)</words>')
+_TAG_RES = {
+    tag: re.compile(rf'<{tag}>([^<]+)</{tag}>')
+    for tag in ('work-title', 'movement-title')
+}
+_CREATOR_TYPES = ('composer', 'lyricist', 'arranger')
+_CREATOR_RES = {
+    creator_type: re.compile(rf'<creator[^>]*type="{creator_type}"[^>]*>([^<]+)</creator>')
+    for creator_type in _CREATOR_TYPES
+}
+
+# Words that mark a <words> direction as tempo/expression text (not just dynamics)
+_TEMPO_KEYWORDS = ('slow', 'fast', 'allegro', 'andante', 'moderato', 'adagio',
+                   'presto', 'largo', 'vivace', 'lento', 'grave', 'tempo',
+                   'with', 'lilt', 'espressivo', 'dolce', 'cantabile',
+                   'maestoso', 'animato', 'tranquillo', 'agitato')
+
+# Key signature fifths -> major key names
+_KEY_NAMES = {
+    -7: 'Cb', -6: 'Gb', -5: 'Db', -4: 'Ab', -3: 'Eb', -2: 'Bb', -1: 'F',
+    0: 'C', 1: 'G', 2: 'D', 3: 'A', 4: 'E', 5: 'B', 6: 'F#', 7: 'C#'
+}
+
+DEFAULT_TEMPO = 120
+
+# Duration types that should be beamed
+_BEAMABLE_TYPES = frozenset({'eighth', '16th', '32nd', '64th', '128th'})
 
 # Monkey-patch HOMR to preserve tuplets during transcription
 # HOMR's default behavior aggressively removes "over-eager" tuplets, which
@@ -35,6 +90,8 @@ _vocab._fix_over_eager_tuplets = _patched_fix_over_eager_tuplets
 # =============================================================================
 _original_build_note_chord = _xmlgen.build_note_chord
 
+_FRACTION_ZERO = Fraction(0)
+
 def _patched_build_note_chord(note_chord, state, chord_duration):
     """
     Patched version that preserves slurs and ties in the MusicXML output.
@@ -48,7 +105,7 @@ def _patched_build_note_chord(note_chord, state, chord_duration):
     # Group notes by duration
     by_duration = _xmlgen._group_notes(stripped_chord.symbols)
     result = []
-    final_duration = Fraction(0)
+    final_duration = _FRACTION_ZERO
 
     for i, group_duration in enumerate(sorted(by_duration)):
         is_first = True
@@ -59,7 +116,7 @@ def _patched_build_note_chord(note_chord, state, chord_duration):
                 note = note.add_articulations(slurs_ties)
             result.append(_xmlgen.build_note_or_rest(note, i, not is_first, state, stripped_chord.tuplet_mark))
             is_first = False
-        if i != len(by_duration) - 1 and group_duration > Fraction(0):
+        if i != len(by_duration) - 1 and group_duration > _FRACTION_ZERO:
             backup = _xmlgen.mxl.XMLBackup()
             backup.add_child(_xmlgen.mxl.XMLDuration(value_=int(group_duration * state.division)))
             result.append(backup)
@@ -84,6 +141,21 @@ _xmlgen.build_note_chord = _patched_build_note_chord
 # =============================================================================
 _original_find_division_and_time_signature = _xmlgen.find_division_and_time_signature_nominator
 
+# Common time signatures (as fractions of a whole note), paired with their float values
+# 2/4 = 0.5, 3/4 = 0.75, 4/4 = 1.0, 3/8 = 0.375, 6/8 = 0.75
+# NOTE: 5/4 is intentionally excluded - it's rare and often a misdetection of 4/4
+_COMMON_NOMINATORS = [
+    (n, float(n)) for n in (
+        Fraction(2, 4),   # 2/4
+        Fraction(3, 8),   # 3/8
+        Fraction(3, 4),   # 3/4
+        Fraction(4, 4),   # 4/4 (most common)
+        Fraction(6, 8),   # 6/8
+        Fraction(9, 8),   # 9/8
+        Fraction(12, 8),  # 12/8
+    )
+]
+
 def _patched_find_division_and_time_signature(voice):
     """
     Patched version that snaps time signatures to common values.
@@ -91,26 +163,11 @@ def _patched_find_division_and_time_signature(voice):
     The original uses np.median(measure_duration) which can produce unusual
     time signatures like 5/4. This patch snaps to the nearest common signature.
     """
-    import numpy as np
-
     division, nominator = _original_find_division_and_time_signature(voice)
 
-    # Common time signatures (as fractions of a whole note)
-    # 2/4 = 0.5, 3/4 = 0.75, 4/4 = 1.0, 3/8 = 0.375, 6/8 = 0.75
-    # NOTE: 5/4 is intentionally excluded - it's rare and often a misdetection of 4/4
-    common_nominators = [
-        Fraction(2, 4),   # 2/4
-        Fraction(3, 8),   # 3/8
-        Fraction(3, 4),   # 3/4
-        Fraction(4, 4),   # 4/4 (most common)
-        Fraction(6, 8),   # 6/8
-        Fraction(9, 8),   # 9/8
-        Fraction(12, 8),  # 12/8
-    ]
-
     # Find the closest common time signature
     nominator_float = float(nominator)
-    closest = min(common_nominators, key=lambda x: abs(float(x) - nominator_float))
+    closest = min(_COMMON_NOMINATORS, key=lambda t: abs(t[1] - nominator_float))[0]
 
     # Debug: log when we snap the time signature
     if closest != nominator:
@@ -221,25 +278,499 @@ def inject_dynamics_into_musicxml(musicxml_content: str, dynamics: list) -> str:
 # =============================================================================
 
 
+# =============================================================================
+# Patch 5: Tuned ONNX Runtime sessions
+# HOMR builds its InferenceSessions with default options. On CUDA that means an
+# EXHAUSTIVE cuDNN conv algorithm search, which stalls the first inference for
+# seconds and gives poor steady-state latency for the convolutional detectors.
+# We wrap the session constructor so every HOMR model gets tuned providers and
+# session options.
+# =============================================================================
+_CUDA_PROVIDER_OPTIONS = {
+    "cudnn_conv_algo_search": "DEFAULT",
+    "do_copy_in_default_stream": True,
+    "arena_extend_strategy": "kSameAsRequested",
+}
+
+
+def _physical_core_count() -> int:
+    """
+    Count the physical CPU cores this process may run on (hyperthreads don't
+    help ORT's compute-bound kernels; cores outside its affinity or cpuset,
+    e.g. in a container or under taskset, can't be used at all).
+    """
+    try:
+        allowed = os.sched_getaffinity(0)
+    except AttributeError:
+        allowed = None
+    try:
+        cores = set()
+        processor = physical_id = None
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                key = key.strip()
+                if key == "processor":
+                    processor = int(value)
+                elif key == "physical id":
+                    physical_id = value.strip()
+                elif key == "core id" and (allowed is None or processor in allowed):
+                    cores.add((physical_id, value.strip()))
+        if cores:
+            return min(len(cores), len(allowed)) if allowed else len(cores)
+    except (OSError, ValueError):
+        pass
+    if allowed:
+        return len(allowed)
+    return os.cpu_count() or 1
+
+
+def _execution_providers() -> list:
+    """Return ONNX Runtime providers in order of preference, with CUDA tuning options."""
+    if "CUDAExecutionProvider" in ort.get_available_providers():
+        return [("CUDAExecutionProvider", _CUDA_PROVIDER_OPTIONS), "CPUExecutionProvider"]
+    return ["CPUExecutionProvider"]
+
+
+def _provider_names(providers: list) -> list:
+    """Strip provider options, leaving just the provider names."""
+    return [p[0] if isinstance(p, tuple) else p for p in providers]
+
+
+def _use_gpu() -> bool:
+    """Check if GPU inference is available."""
+    return "CUDAExecutionProvider" in _provider_names(_execution_providers())
+
+
+# Processes on this host that run HOMR sessions side by side. Uvicorn reads
+# WEB_CONCURRENCY as its --workers default; set it when using --workers so the
+# processes split the cores instead of each starting cpu_count() threads.
+_WEB_CONCURRENCY = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+_ort_processes = _WEB_CONCURRENCY
+
+
+def _intra_op_threads() -> int:
+    """This process's share of the physical cores."""
+    return max(1, _physical_core_count() // _ort_processes)
+
+
+def _session_options() -> ort.SessionOptions:
+    """Session options applied to every HOMR model."""
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.enable_mem_pattern = False
+    # Only matters for the CPU fallback; CUDA kernels don't use the ORT thread pool
+    options.intra_op_num_threads = _intra_op_threads()
+    options.inter_op_num_threads = 1
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    return options
+
+
+_OPTIMIZED_SUFFIX = ".opt.onnx"
+
+
+def _host_tag() -> str:
+    """
+    Short fingerprint of the CPU this process runs on.
+
+    ORT_ENABLE_ALL graphs may contain hardware-specific optimizations, so a
+    saved graph is only reused on the same kind of CPU.
+    """
+    cpu = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key.strip() in ("model name", "flags"):
+                    cpu += value.strip()
+                elif not line.strip():
+                    break  # The first processor's block is enough
+    except OSError:
+        pass
+    return hashlib.blake2b(f"{platform.machine()}:{cpu}".encode(), digest_size=4).hexdigest()
+
+
+_HOST_TAG = _host_tag()
+
+
+def _optimized_path(model_path: str, use_gpu: bool) -> str:
+    """Path where the optimized graph of a model is saved for this device, host and ORT."""
+    device = "gpu" if use_gpu else "cpu"
+    tag = f"{device}.ort{ort.__version__}.{_HOST_TAG}"
+    return str(Path(model_path).with_suffix("")) + f".{tag}{_OPTIMIZED_SUFFIX}"
+
+
+_original_inference_session = ort.InferenceSession
+
+# Loaded sessions, keyed by (model path, use_gpu). HOMR reloads its models on
+# every process_image call; reusing sessions skips the load and warmup each time.
+_session_cache = {}
+
+def _patched_inference_session(path_or_bytes, sess_options=None, providers=None,
+                               provider_options=None, **kwargs):
+    """
+    Replacement for ort.InferenceSession used by HOMR's model loaders.
+
+    Fills in our session options when HOMR doesn't supply any, and swaps a plain
+    CUDA provider request for the tuned provider list. Sessions loaded from a
+    model path are cached and shared across requests.
+    """
+    use_gpu = "CUDAExecutionProvider" in _provider_names(providers or [])
+    cache_key = None
+    if isinstance(path_or_bytes, (str, os.PathLike)):
+        path_or_bytes = _resolve_model_path(str(path_or_bytes), use_gpu)
+        cache_key = (os.path.realpath(path_or_bytes), use_gpu)
+        if cache_key in _session_cache:
+            return _session_cache[cache_key]
+
+    session = _create_session(path_or_bytes, sess_options, providers, provider_options, **kwargs)
+    if cache_key is not None:
+        _session_cache[cache_key] = session
+    return session
+
+
+def _create_session(path_or_bytes, sess_options, providers, provider_options, **kwargs):
+    """
+    Build a session with our tuned options and providers.
+
+    The first load of a model file saves ORT's fully optimized (fused) graph
+    next to it; later boots load that graph directly and skip the optimization
+    passes. Optimized graphs can contain provider- and hardware-specific nodes,
+    so they're kept separately per device, CPU type and ORT version.
+    """
+    use_gpu = "CUDAExecutionProvider" in _provider_names(providers or [])
+    if use_gpu:
+        providers = _execution_providers()
+        provider_options = None
+
+    if sess_options is None:
+        sess_options = _session_options()
+        if isinstance(path_or_bytes, str) and path_or_bytes.endswith(".onnx"):
+            optimized_path = _optimized_path(path_or_bytes, use_gpu)
+            if os.path.exists(optimized_path):
+                try:
+                    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+                    return _original_inference_session(
+                        optimized_path,
+                        sess_options=sess_options,
+                        providers=providers,
+                        provider_options=provider_options,
+                        **kwargs
+                    )
+                except Exception as e:
+                    print(f"[DEBUG] Discarding unusable optimized model {optimized_path}: {e}")
+                    try:
+                        os.remove(optimized_path)
+                    except FileNotFoundError:
+                        pass
+                    sess_options = _session_options()
+
+            # Several worker processes may save the same graph at once, so each
+            # writes its own temp file and renames it into place
+            temp_path = _temp_sibling(optimized_path)
+            sess_options.optimized_model_filepath = temp_path
+            try:
+                session = _original_inference_session(
+                    path_or_bytes,
+                    sess_options=sess_options,
+                    providers=providers,
+                    provider_options=provider_options,
+                    **kwargs
+                )
+                if os.path.exists(temp_path):
+                    os.replace(temp_path, optimized_path)
+                return session
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+    return _original_inference_session(
+        path_or_bytes,
+        sess_options=sess_options,
+        providers=providers,
+        provider_options=provider_options,
+        **kwargs
+    )
+
+
+def _temp_sibling(path: str) -> str:
+    """Process-private temp name next to path (keeping the .onnx extension ORT expects)."""
+    return str(Path(path).with_suffix("")) + f".{os.getpid()}.tmp.onnx"
+
+
+@contextmanager
+def _models_lock():
+    """
+    Hold an exclusive lock on HOMR's model directory across processes.
+
+    Worker processes start together, and download_weights() downloads and
+    unzips into shared file names, so only one may fetch or convert models
+    at a time.
+    """
+    if fcntl is None:
+        yield
+        return
+    try:
+        lock_file = open(_MODELS_DIR / ".homr_models.lock", "w")
+    except OSError:
+        # Read-only install: nothing can be written there anyway
+        yield
+        return
+    with lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# Apply the session patch (HOMR looks up ort.InferenceSession at call time)
+ort.InferenceSession = _patched_inference_session
+
+
+# =============================================================================
+# Optional INT8 weights for CPU-only deployments
+# Set HOMR_QUANTIZE=1 to dynamically quantize HOMR's models after download.
+# GPU inference always uses the original FP32 models.
+# =============================================================================
+_QUANTIZE = os.environ.get("HOMR_QUANTIZE") == "1"
+_INT8_SUFFIX = "_int8.onnx"
+_INT8_MARKER = ".done"
+
+
+def _int8_path(model_path: str) -> str:
+    """Path of the quantized variant of a model."""
+    return str(Path(model_path).with_suffix("")) + _INT8_SUFFIX
+
+
+def _quantize_models() -> None:
+    """
+    Write an INT8 copy of each CPU model, skipping ones already done.
+
+    Call with _models_lock() held.
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    for model_path in _device_model_paths(False):
+        int8_path = _int8_path(model_path)
+        if not os.path.exists(model_path) or os.path.exists(int8_path + _INT8_MARKER):
+            continue
+        temp_path = _temp_sibling(int8_path)
+        try:
+            print(f"Quantizing {os.path.basename(model_path)} to INT8 (first time only)...")
+            # Only MatMuls: the CPU provider has no ConvInteger kernel for int8 weights
+            quantize_dynamic(
+                model_path,
+                temp_path,
+                weight_type=QuantType.QInt8,
+                op_types_to_quantize=["MatMul"]
+            )
+            os.replace(temp_path, int8_path)
+            Path(int8_path + _INT8_MARKER).touch()
+        except Exception as e:
+            print(f"[DEBUG] Quantization failed for {os.path.basename(model_path)}, using FP32: {e}")
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+def _resolve_model_path(model_path: str, use_gpu: bool) -> str:
+    """Swap in the INT8 variant of a model on the CPU path, if one was built."""
+    if _QUANTIZE and not use_gpu and model_path.endswith(".onnx"):
+        int8_path = _int8_path(model_path)
+        if os.path.exists(int8_path + _INT8_MARKER):
+            return int8_path
+    return model_path
+
+
+# ONNX input types -> numpy dtypes, for building warmup tensors
+_ORT_DTYPES = {
+    "tensor(float)": np.float32,
+    "tensor(float16)": np.float16,
+    "tensor(double)": np.float64,
+    "tensor(int64)": np.int64,
+    "tensor(int32)": np.int32,
+    "tensor(bool)": np.bool_,
+}
+
+
+def _device_model_paths(use_gpu: bool) -> list:
+    """The models download_weights(use_gpu) fetches, and HOMR loads, for a device."""
+    filepaths = default_config.filepaths
+    if use_gpu:
+        return [segnet_path_onnx_fp16, filepaths.encoder_path_fp16, filepaths.decoder_path_fp16]
+    return [segnet_path_onnx, filepaths.encoder_path, filepaths.decoder_path]
+
+
+def _warm_up_sessions(use_gpu: bool) -> None:
+    """
+    Load the device's HOMR models into the session cache and run each once.
+
+    The first run triggers cuDNN algorithm selection and arena allocation, so
+    paying it here keeps it off the first request. Dynamic dimensions are set
+    to 1; models whose inputs can't be satisfied with zeros are just loaded.
+    """
+    providers = _execution_providers() if use_gpu else ["CPUExecutionProvider"]
+    for model_path in _device_model_paths(use_gpu):
+        if not os.path.exists(model_path):
+            continue
+        try:
+            session = ort.InferenceSession(model_path, providers=providers)
+            feeds = {
+                inp.name: np.zeros(
+                    [d if isinstance(d, int) and d > 0 else 1 for d in inp.shape],
+                    dtype=_ORT_DTYPES.get(inp.type, np.float32)
+                )
+                for inp in session.get_inputs()
+            }
+            session.run(None, feeds)
+        except Exception as e:
+            print(f"[DEBUG] Warmup skipped for {os.path.basename(model_path)}: {e}")
+
+
+# =============================================================================
+# Patch 6: Fast debug image writes
+# When debug output is on, HOMR writes a dozen full-page PNGs per image at
+# OpenCV's default zlib level. They're deleted with the temp dir, so we trade
+# file size for encode time (level 1 is several times faster to encode).
+# Only homr.debug sees the patched cv2; other cv2.imwrite callers are untouched.
+# =============================================================================
+_DEBUG_PNG_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+
+
+def _patched_debug_imwrite(filename, img, params=None):
+    """cv2.imwrite that uses fast PNG compression unless told otherwise."""
+    if params is None and str(filename).lower().endswith('.png'):
+        params = _DEBUG_PNG_PARAMS
+    if params is None:
+        return cv2.imwrite(filename, img)
+    return cv2.imwrite(filename, img, params)
+
+
+class _DebugCv2:
+    """Stand-in for cv2 inside homr.debug: identical apart from imwrite."""
+    imwrite = staticmethod(_patched_debug_imwrite)
+
+    def __getattr__(self, name):
+        return getattr(cv2, name)
+
+# Apply the debug image patch
+_debug.cv2 = _DebugCv2()
+
+
 # Track if models have been downloaded
 _models_initialized = False
 
+# HOMR_DEBUG=1 makes HOMR write its annotated debug images for every image.
+# They land next to the input, so inspect them before the directory is removed.
+_DEBUG = os.environ.get("HOMR_DEBUG") == "1"
+
+# HOMR downloads its weights into its own package directory
+_MODELS_DIR = Path(homr.__file__).parent
+
+# HOMR's process_image only takes a file path and writes its MusicXML next to
+# the input, so keep those round-trips in RAM (tmpfs) where it's available.
+# HOMR_TMPDIR picks another directory. Uploads fall back to the normal temp
+# dir when this one is short of space (Docker's default /dev/shm is 64MB).
+_TEMP_ROOT = os.environ.get("HOMR_TMPDIR") or ("/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+# Space to leave on the temp root, on top of the upload, for HOMR's own output
+_TEMP_HEADROOM = 128 * 1024 * 1024  # 128MB
+
 
 def _ensure_models_downloaded(use_gpu: bool) -> None:
     """Download HOMR models if not already present."""
     global _models_initialized
     if not _models_initialized:
-        print("Checking/downloading HOMR models (first time only)...")
-        download_weights(use_gpu)
+        with _models_lock():
+            print("Checking/downloading HOMR models (first time only)...")
+            download_weights(use_gpu)
+            if _QUANTIZE and not use_gpu:
+                _quantize_models()
+        _warm_up_sessions(use_gpu)
         _models_initialized = True
 
 
-def _has_gpu() -> bool:
-    """Check if GPU inference is available."""
-    return "CUDAExecutionProvider" in ort.get_available_providers()
+def warm_up_models(pool_size: int = 1) -> None:
+    """
+    Download and load HOMR's models in the current process.
 
+    Used as the initializer for API worker processes so the first request a
+    worker handles doesn't pay for model loading.
 
-def process_sheet_music(image_bytes: bytes, filename: str) -> Tuple[str, List[str], List[str]]:
+    Args:
+        pool_size: Number of worker processes in this server's pool, which
+            share the CPU with each other (and with other WEB_CONCURRENCY servers)
+    """
+    global _ort_processes
+    _ort_processes = _WEB_CONCURRENCY * max(1, pool_size)
+    print(f"ONNX Runtime using {_intra_op_threads()} intra-op thread(s) per session "
+          f"({_ort_processes} process(es) sharing {_physical_core_count()} cores)")
+    _ensure_models_downloaded(_use_gpu())
+
+
+# Results of recent successful runs, keyed by image digest, most recent last.
+# Identical uploads (retries, demos) skip HOMR entirely. 0 disables the cache.
+_RESULT_CACHE_SIZE = int(os.environ.get("HOMR_RESULT_CACHE_SIZE", "64"))
+_result_cache = OrderedDict()
+
+
+def image_hasher():
+    """Return an incremental hasher whose digest keys the result cache."""
+    return hashlib.blake2b(digest_size=16)
+
+
+def get_cached_result(key: bytes) -> Tuple[str, int, dict, List[str], List[str]] | None:
+    """Look up the result of an earlier run on the same image."""
+    result = _result_cache.get(key)
+    if result is not None:
+        _result_cache.move_to_end(key)
+    return result
+
+
+def cache_result(key: bytes, result: Tuple[str, int, dict, List[str], List[str]]) -> None:
+    """Remember a run's result, unless it failed (so retries get a fresh attempt)."""
+    musicxml_content, _, _, _, errors = result
+    if _RESULT_CACHE_SIZE <= 0 or not musicxml_content or errors:
+        return
+    _result_cache[key] = result
+    _result_cache.move_to_end(key)
+    while len(_result_cache) > _RESULT_CACHE_SIZE:
+        _result_cache.popitem(last=False)
+
+
+def _temp_root(expected_size: int):
+    """The temp root to use for an upload, or None for the system temp dir."""
+    if _TEMP_ROOT is None:
+        return None
+    try:
+        free = shutil.disk_usage(_TEMP_ROOT).free
+    except OSError:
+        return None
+    return _TEMP_ROOT if free >= expected_size + _TEMP_HEADROOM else None
+
+
+def create_upload_path(filename: str, expected_size: int = 0, on_disk: bool = False) -> str:
+    """
+    Create a private temp directory (tmpfs-backed on Linux) and return the path
+    an uploaded image should be saved to inside it.
+
+    The caller owns the directory and must remove it once processing is done.
+
+    Args:
+        filename: Original filename (for extension detection)
+        expected_size: Upload size in bytes, if known, used to check free space
+        on_disk: Use the system temp dir (e.g. after the temp root ran out of space)
+    """
+    ext = Path(filename or "").suffix.lower()
+    if ext not in ['.png', '.jpg', '.jpeg']:
+        ext = '.png'
+
+    temp_dir = tempfile.mkdtemp(dir=None if on_disk else _temp_root(expected_size))
+    return os.path.join(temp_dir, f"input{ext}")
+
+
+def process_sheet_music(image_bytes: bytes, filename: str) -> Tuple[str, int, dict, List[str], List[str]]:
     """
     Process sheet music image using HOMR and return MusicXML.
 
@@ -248,34 +779,60 @@ def process_sheet_music(image_bytes: bytes, filename: str) -> Tuple[str, List[st
         filename: Original filename (for extension detection)
 
     Returns:
-        Tuple of (musicxml_content, warnings, errors)
+        Tuple of (musicxml_content, tempo, metadata, warnings, errors)
+    """
+    hasher = image_hasher()
+    hasher.update(image_bytes)
+    cache_key = hasher.digest()
+    cached = get_cached_result(cache_key)
+    if cached is not None:
+        return cached
+
+    temp_image_path = create_upload_path(filename, len(image_bytes))
+
+    try:
+        # Save image to temp file
+        with open(temp_image_path, 'wb') as f:
+            f.write(image_bytes)
+
+        result = process_sheet_music_file(temp_image_path)
+        cache_result(cache_key, result)
+        return result
+
+    finally:
+        # Clean up temp directory
+        shutil.rmtree(os.path.dirname(temp_image_path), ignore_errors=True)
+
+
+def process_sheet_music_file(temp_image_path: str) -> Tuple[str, int, dict, List[str], List[str]]:
+    """
+    Process a sheet music image already saved by create_upload_path().
+
+    HOMR writes its output next to the image, so the image must be alone in
+    its own directory. The directory is left for the caller to remove.
+
+    Args:
+        temp_image_path: Path returned by create_upload_path()
+
+    Returns:
+        Tuple of (musicxml_content, tempo, metadata, warnings, errors)
     """
     warnings = []
     errors = []
     musicxml_content = ""
+    tempo = DEFAULT_TEMPO
+    metadata = {}
 
     # Check GPU availability
-    use_gpu = _has_gpu()
+    use_gpu = _use_gpu()
 
     # Ensure models are downloaded
     _ensure_models_downloaded(use_gpu)
 
-    # Create temp directory for processing
-    temp_dir = tempfile.mkdtemp()
-
     try:
-        # Save image to temp file
-        ext = Path(filename).suffix.lower()
-        if ext not in ['.png', '.jpg', '.jpeg']:
-            ext = '.png'
-
-        temp_image_path = os.path.join(temp_dir, f"input{ext}")
-        with open(temp_image_path, 'wb') as f:
-            f.write(image_bytes)
-
-        # Configure HOMR (debug enabled temporarily for diagnostics)
+        # Configure HOMR
         config = ProcessingConfig(
-            enable_debug=True,
+            enable_debug=_DEBUG,
             enable_cache=False,
             write_staff_positions=False,
             read_staff_positions=False,
@@ -292,30 +849,21 @@ def process_sheet_music(image_bytes: bytes, filename: str) -> Tuple[str, List[st
         # Process the image
         process_image(temp_image_path, config, xml_args)
 
-        # Find the generated MusicXML file
-        musicxml_path = os.path.join(temp_dir, "input.musicxml")
+        # HOMR writes the MusicXML next to the image, with the extension swapped
+        musicxml_path = Path(temp_image_path).with_suffix('.musicxml')
 
-        if os.path.exists(musicxml_path):
-            with open(musicxml_path, 'r', encoding='utf-8') as f:
-                musicxml_content = f.read()
-        else:
-            # Try alternative naming
-            for file in os.listdir(temp_dir):
-                if file.endswith('.musicxml'):
-                    with open(os.path.join(temp_dir, file), 'r', encoding='utf-8') as f:
-                        musicxml_content = f.read()
-                    break
+        if musicxml_path.exists():
+            musicxml_content = musicxml_path.read_text(encoding='utf-8')
 
         if not musicxml_content:
             errors.append("Failed to generate MusicXML output")
         else:
-            # Post-process: Add beam elements for proper eighth note grouping
-            musicxml_content = add_beam_elements_to_musicxml(musicxml_content)
+            # Post-process: Add beam elements for proper eighth note grouping,
+            # picking up tempo and metadata in the same pass
+            # (plus the part ids and staves counts for the diagnostic below)
+            musicxml_content, tempo, metadata, parts, staves_per_part = process_musicxml(musicxml_content)
 
             # Diagnostic: count parts in MusicXML
-            import re
-            parts = re.findall(r'<part id="([^"]+)"', musicxml_content)
-            staves_per_part = re.findall(r'<staves>(\d+)</staves>', musicxml_content)
             print(f"[DEBUG] MusicXML generated with {len(parts)} part(s): {parts}")
             print(f"[DEBUG] Staves per part: {staves_per_part}")
             if len(parts) == 1 and not staves_per_part:
@@ -324,17 +872,23 @@ def process_sheet_music(image_bytes: bytes, filename: str) -> Tuple[str, List[st
     except Exception as e:
         errors.append(f"Processing error: {str(e)}")
 
-    finally:
-        # Clean up temp directory
-        shutil.rmtree(temp_dir, ignore_errors=True)
-
-    return musicxml_content, warnings, errors
+    return musicxml_content, tempo, metadata, warnings, errors
 
 
 def add_beam_elements_to_musicxml(musicxml_content: str) -> str:
     """
     Post-process MusicXML to add explicit beam elements for eighth notes and shorter.
 
+    See process_musicxml(), which also extracts tempo and metadata in the same pass.
+    """
+    return process_musicxml(musicxml_content)[0]
+
+
+def process_musicxml(musicxml_content: str) -> Tuple[str, int, dict, List[str], List[str]]:
+    """
+    Post-process MusicXML to add explicit beam elements for eighth notes and shorter,
+    collecting the tempo and metadata on the way through.
+
     This fixes the issue where consecutive quavers (eighth notes) are displayed
     as individual notes instead of being beamed together. OSMD's autoBeam doesn't
     work reliably when notes are in different voices due to chord duration grouping.
@@ -344,100 +898,227 @@ def add_beam_elements_to_musicxml(musicxml_content: str) -> str:
     - Don't beam across rests
     - Don't beam notes with different voices
     - Start new beam groups at beat boundaries (for common time signatures)
+
+    The document is streamed rather than parsed into one tree: each measure is
+    beamed and written out as soon as its end tag is read, then dropped, so
+    only one measure is held in memory at a time. Tempo and metadata give the
+    same results as extract_tempo_from_musicxml() and
+    extract_metadata_from_musicxml() without extra passes over the string.
+
+    Returns:
+        Tuple of (musicxml_content, tempo, metadata, part_ids, staves), where
+        staves holds every <staves> count in document order. If the MusicXML
+        can't be parsed it is returned unchanged, with the rest taken from the
+        regex extractors.
     """
-    import re
-    from xml.etree import ElementTree as ET
+    output = io.StringIO()
+    writer = XMLGenerator(output, encoding='UTF-8')
+    writer.startDocument()
+
+    # Open elements as (element, is_container). Containers (the score root and
+    # its parts) are written tag by tag; everything below them is written whole.
+    stack = []
+    found = {}
+    parts = []
+    staves = []
 
     try:
-        # Parse the MusicXML
-        root = ET.fromstring(musicxml_content)
+        events = ET.iterparse(io.BytesIO(musicxml_content.encode('utf-8')), events=('start', 'end'))
+        for event, elem in events:
+            if event == 'start':
+                is_container = not stack or (len(stack) == 1 and elem.tag == 'part')
+                if is_container:
+                    if stack:
+                        writer.ignorableWhitespace('\n')
+                    writer.startElement(elem.tag, dict(elem.attrib))
+                    if elem.tag == 'part' and elem.get('id'):
+                        parts.append(elem.get('id'))
+                stack.append((elem, is_container))
+                continue
+
+            _, is_container = stack.pop()
+            if is_container:
+                writer.ignorableWhitespace('\n')
+                writer.endElement(elem.tag)
+            elif stack[-1][1]:
+                # A complete child of the root or of a part
+                if elem.tag == 'measure':
+                    _add_beams_to_measure(elem)
+                    for count in elem.iterfind('attributes/staves'):
+                        if count.text and count.text.strip().isdigit():
+                            staves.append(count.text.strip())
+                _collect_metadata(elem, found)
+                writer.ignorableWhitespace('\n')
+                output.write(ET.tostring(elem, encoding='unicode', with_tail=False))
+                stack[-1][0].remove(elem)
     except ET.ParseError:
         # If parsing fails, return original content
-        return musicxml_content
-
-    # Duration types that should be beamed
-    beamable_types = {'eighth', '16th', '32nd', '64th', '128th'}
-
-    # Process each part
-    for part in root.findall('.//part'):
-        # Process each measure
-        for measure in part.findall('measure'):
-            # Group notes by voice
-            voice_notes = {}
+        return (musicxml_content,
+                extract_tempo_from_musicxml(musicxml_content),
+                extract_metadata_from_musicxml(musicxml_content),
+                _PART_RE.findall(musicxml_content),
+                _STAVES_RE.findall(musicxml_content))
 
-            for note in measure.findall('note'):
-                # Skip rests, grace notes, and chord continuation notes
-                if note.find('rest') is not None:
-                    continue
-                if note.find('grace') is not None:
-                    continue
+    writer.ignorableWhitespace('\n')
+    writer.endDocument()
 
-                # Get voice (default to 1)
-                voice_el = note.find('voice')
-                voice = voice_el.text if voice_el is not None else '1'
-
-                # Get note type
-                type_el = note.find('type')
-                if type_el is None:
-                    continue
-                note_type = type_el.text
+    tempo = found.get('per-minute') or found.get('sound-tempo') or DEFAULT_TEMPO
+    beats, beat_type = found.get('beats'), found.get('beat-type')
+    metadata = {
+        'title': found.get('work-title') or found.get('movement-title'),
+        'composer': found.get('composer'),
+        'lyricist': found.get('lyricist'),
+        'arranger': found.get('arranger'),
+        'tempo_text': found.get('words'),
+        'time_signature': f"{beats}/{beat_type}" if beats and beat_type else None,
+        'key_signature': _key_name(found['fifths']) if 'fifths' in found else None,
+    }
 
-                # Check if this is a beamable note
-                if note_type not in beamable_types:
-                    # Non-beamable note breaks the beam group
-                    if voice in voice_notes and voice_notes[voice]:
-                        # End any pending beam group
-                        _finalize_beam_group(voice_notes[voice])
-                        voice_notes[voice] = []
-                    continue
+    # Remove None values for cleaner output
+    return output.getvalue(), tempo, {k: v for k, v in metadata.items() if v is not None}, parts, staves
 
-                # Check if this is a chord note (has <chord/> element)
-                is_chord = note.find('chord') is not None
 
-                # Initialize voice list if needed
-                if voice not in voice_notes:
-                    voice_notes[voice] = []
+def _collect_metadata(elem, found: dict) -> None:
+    """
+    Record the first tempo and metadata values inside a top-level element.
 
-                # Add note to the current beam group for this voice
-                voice_notes[voice].append(note)
+    Only the places MusicXML allows these values are searched: a measure's
+    attributes, directions and sounds, and the header elements before the parts.
+    """
+    def _first(key, value):
+        if value and key not in found:
+            found[key] = value
+
+    def _text(el):
+        return el.text.strip() if el is not None and el.text else None
+
+    if elem.tag != 'measure':
+        _first('work-title', _text(elem.find('.//work-title')))
+        if elem.tag == 'movement-title':
+            _first('movement-title', _text(elem))
+        for creator in elem.iter('creator'):
+            if creator.get('type') in _CREATOR_TYPES:
+                _first(creator.get('type'), _text(creator))
+        return
 
-            # Finalize any remaining beam groups
-            for voice, notes in voice_notes.items():
-                if notes:
-                    _finalize_beam_group(notes)
+    for child in elem:
+        if child.tag == 'attributes':
+            beats = _text(child.find('time/beats'))
+            beat_type = _text(child.find('time/beat-type'))
+            fifths = _text(child.find('key/fifths'))
+            _first('beats', beats if beats and beats.isdigit() else None)
+            _first('beat-type', beat_type if beat_type and beat_type.isdigit() else None)
+            if fifths and fifths.lstrip('-').isdigit() and 'fifths' not in found:
+                found['fifths'] = int(fifths)
+        elif child.tag == 'direction':
+            for words in child.iter('words'):
+                text = _text(words)
+                if text and _is_tempo_text(text):
+                    _first('words', text)
+            per_minute = _text(child.find('.//per-minute'))
+            if per_minute and per_minute.isdigit():
+                _first('per-minute', int(per_minute))
+
+        # <sound tempo="..."> sits in a direction or directly in the measure
+        sound = child if child.tag == 'sound' else child.find('sound')
+        if sound is not None and sound.get('tempo', '').isdigit():
+            _first('sound-tempo', int(sound.get('tempo')))
+
+
+def _is_tempo_text(words: str) -> bool:
+    """Check if direction text looks like a tempo/expression marking."""
+    words_lower = words.lower()
+    return any(kw in words_lower for kw in _TEMPO_KEYWORDS)
+
+
+def _key_name(fifths: int) -> str:
+    """Map a key signature's fifths value to its major key name."""
+    return _KEY_NAMES.get(fifths, f"{fifths} sharps/flats")
+
+
+def _add_beams_to_measure(measure):
+    """
+    Group a measure's beamable notes by voice and beam each run.
 
-    # Convert back to string, restoring the XML declaration that ET.tostring strips
-    return '<?xml version="1.0" encoding="UTF-8"?>\n' + ET.tostring(root, encoding='unicode')
+    Works in three passes: read each note's attributes once into parallel
+    lists, decide beam roles using only those lists, then edit the elements.
+    """
+    # Pass 1: extract note attributes
+    elems = []
+    beams = []
+    voices = []
+    types = []
+    skipped = []
+
+    for note in measure.findall('note'):
+        # Index the note's children in one pass instead of a find() per lookup.
+        # Beams can repeat (one per beam level), so collect those separately.
+        children = {}
+        note_beams = []
+        for child in note:
+            if child.tag == 'beam':
+                note_beams.append(child)
+            else:
+                children[child.tag] = child
+
+        # Get voice (default to 1)
+        voice_el = children.get('voice')
+        type_el = children.get('type')
+
+        elems.append(note)
+        beams.append(note_beams)
+        voices.append(voice_el.text if voice_el is not None else '1')
+        types.append(type_el.text if type_el is not None else None)
+        # Rests, grace notes and untyped notes are ignored: they neither join
+        # nor break a beam group
+        skipped.append('rest' in children or 'grace' in children or type_el is None)
+
+    # Pass 2: group consecutive beamable notes per voice and assign roles
+    roles = [None] * len(elems)
+    voice_groups = {}
+
+    for i, (voice, note_type) in enumerate(zip(voices, types)):
+        if skipped[i]:
+            continue
+        if note_type in _BEAMABLE_TYPES:
+            # Chord notes (<chord/>) join the group like any other note
+            voice_groups.setdefault(voice, []).append(i)
+        elif voice_groups.get(voice):
+            # Non-beamable note breaks the beam group
+            _assign_beam_roles(voice_groups[voice], roles)
+            voice_groups[voice] = []
+
+    # Finalize any remaining beam groups
+    for group in voice_groups.values():
+        _assign_beam_roles(group, roles)
+
+    # Pass 3: replace existing beams on grouped notes with the new ones
+    for note, note_beams, role in zip(elems, beams, roles):
+        if role is None:
+            continue
+        for existing_beam in note_beams:
+            note.remove(existing_beam)
+        beam = ET.SubElement(note, 'beam')
+        beam.set('number', '1')
+        beam.text = role
 
 
-def _finalize_beam_group(notes):
+def _assign_beam_roles(group, roles):
     """
-    Add beam elements to a group of notes.
+    Set the beam role of each note index in a group.
 
     Beam groups of 2 or more notes get:
     - First note: <beam number="1">begin</beam>
     - Middle notes: <beam number="1">continue</beam>
     - Last note: <beam number="1">end</beam>
     """
-    if len(notes) < 2:
+    if len(group) < 2:
         return
 
-    for i, note in enumerate(notes):
-        # Remove any existing beam elements
-        for existing_beam in note.findall('beam'):
-            note.remove(existing_beam)
-
-        # Create new beam element
-        from xml.etree import ElementTree as ET
-        beam = ET.SubElement(note, 'beam')
-        beam.set('number', '1')
-
-        if i == 0:
-            beam.text = 'begin'
-        elif i == len(notes) - 1:
-            beam.text = 'end'
-        else:
-            beam.text = 'continue'
+    for index in group:
+        roles[index] = 'continue'
+    roles[group[0]] = 'begin'
+    roles[group[-1]] = 'end'
 
 
 def extract_tempo_from_musicxml(musicxml_content: str) -> int:
@@ -445,20 +1126,18 @@ def extract_tempo_from_musicxml(musicxml_content: str) -> int:
     Extract tempo from MusicXML content.
     Returns default of 120 if not found.
     """
-    import re
-
     # Look for tempo marking in MusicXML
     # <per-minute>120</per-minute> or <sound tempo="120"/>
 
-    per_minute_match = re.search(r'<per-minute>(\d+)</per-minute>', musicxml_content)
+    per_minute_match = _PER_MINUTE_RE.search(musicxml_content)
     if per_minute_match:
         return int(per_minute_match.group(1))
 
-    sound_tempo_match = re.search(r'<sound[^>]*tempo="(\d+)"', musicxml_content)
+    sound_tempo_match = _SOUND_TEMPO_RE.search(musicxml_content)
     if sound_tempo_match:
         return int(sound_tempo_match.group(1))
 
-    return 120  # Default tempo
+    return DEFAULT_TEMPO
 
 
 def extract_metadata_from_musicxml(musicxml_content: str) -> dict:
@@ -466,53 +1145,41 @@ def extract_metadata_from_musicxml(musicxml_content: str) -> dict:
     Extract metadata (title, composer, tempo text, time signature, key signature)
     from MusicXML content.
     """
-    import re
 
     def _extract_tag(content: str, tag: str) -> str | None:
         """Extract text content from an XML tag."""
-        match = re.search(rf'<{tag}>([^<]+)</{tag}>', content)
+        match = _TAG_RES[tag].search(content)
         return match.group(1).strip() if match else None
 
     def _extract_creator(content: str, creator_type: str) -> str | None:
         """Extract creator (composer, lyricist, etc.) from MusicXML."""
-        match = re.search(rf'<creator[^>]*type="{creator_type}"[^>]*>([^<]+)</creator>', content)
+        match = _CREATOR_RES[creator_type].search(content)
         return match.group(1).strip() if match else None
 
     def _extract_direction_words(content: str) -> str | None:
         """Extract tempo/expression text from direction-type words elements."""
         # Look for <words> elements that contain tempo/expression markings
         # These are typically at the beginning of the piece
-        words_matches = re.findall(r'<words[^>]*>([^<]+)</words>', content)
+        words_matches = _WORDS_RE.findall(content)
         # Filter to likely tempo/expression markings (not just dynamics)
-        tempo_keywords = ['slow', 'fast', 'allegro', 'andante', 'moderato', 'adagio',
-                         'presto', 'largo', 'vivace', 'lento', 'grave', 'tempo',
-                         'with', 'lilt', 'espressivo', 'dolce', 'cantabile',
-                         'maestoso', 'animato', 'tranquillo', 'agitato']
         for words in words_matches:
-            words_lower = words.lower()
-            if any(kw in words_lower for kw in tempo_keywords):
+            if _is_tempo_text(words):
                 return words.strip()
         return None
 
     def _extract_time_signature(content: str) -> str | None:
         """Extract time signature from MusicXML."""
-        beats_match = re.search(r'<beats>(\d+)</beats>', content)
-        beat_type_match = re.search(r'<beat-type>(\d+)</beat-type>', content)
+        beats_match = _BEATS_RE.search(content)
+        beat_type_match = _BEAT_TYPE_RE.search(content)
         if beats_match and beat_type_match:
             return f"{beats_match.group(1)}/{beat_type_match.group(1)}"
         return None
 
     def _extract_key_signature(content: str) -> str | None:
         """Extract key signature from MusicXML fifths value."""
-        fifths_match = re.search(r'<fifths>(-?\d+)</fifths>', content)
+        fifths_match = _FIFTHS_RE.search(content)
         if fifths_match:
-            fifths = int(fifths_match.group(1))
-            # Map fifths to key names (major keys)
-            key_map = {
-                -7: 'Cb', -6: 'Gb', -5: 'Db', -4: 'Ab', -3: 'Eb', -2: 'Bb', -1: 'F',
-                0: 'C', 1: 'G', 2: 'D', 3: 'A', 4: 'E', 5: 'B', 6: 'F#', 7: 'C#'
-            }
-            return key_map.get(fifths, f"{fifths} sharps/flats")
+            return _key_name(int(fifths_match.group(1)))
         return None
 
     # Extract all metadata
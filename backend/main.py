@@ -1,12 +1,132 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
+import errno
+import multiprocessing
+import os
+import shutil
 import time
 
-from homr_wrapper import process_sheet_music, extract_tempo_from_musicxml, extract_metadata_from_musicxml
+from homr_wrapper import (
+    create_upload_path,
+    process_sheet_music_file,
+    image_hasher,
+    get_cached_result,
+    cache_result,
+    warm_up_models,
+    DEFAULT_TEMPO,
+)
+
+# HOMR inference is synchronous CPU/GPU work, so it runs in worker processes
+# that keep their models loaded. Set NUM_GPUS to run one worker per GPU,
+# otherwise HOMR_WORKERS workers share the CPU (or a single GPU).
+NUM_GPUS = int(os.environ.get("NUM_GPUS", "0"))
+NUM_WORKERS = NUM_GPUS or int(os.environ.get("HOMR_WORKERS", "1"))
+
+_pool: ProcessPoolExecutor | None = None
+
+
+def _init_worker(worker_ids, num_gpus: int, num_workers: int) -> None:
+    """Pin the worker to its GPU (if any) and load HOMR's models."""
+    worker_id = worker_ids.get()
+    if num_gpus:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(worker_id % num_gpus)
+    try:
+        warm_up_models(num_workers)
+    except Exception as e:
+        # An initializer that raises breaks the whole pool. The worker's first
+        # request retries the download/load instead.
+        print(f"[DEBUG] Worker {worker_id} could not load HOMR models, will retry: {e}")
+
+
+def _start_pool() -> ProcessPoolExecutor:
+    """Start a pool of HOMR workers, all loading their models right away."""
+    # Spawn rather than fork: CUDA and ORT thread pools don't survive a fork
+    context = multiprocessing.get_context("spawn")
+    worker_ids = context.Queue()
+    for worker_id in range(NUM_WORKERS):
+        worker_ids.put(worker_id)
+    pool = ProcessPoolExecutor(
+        max_workers=NUM_WORKERS,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(worker_ids, NUM_GPUS, NUM_WORKERS),
+    )
+    # Start every worker now so models are loaded before the first request
+    for _ in range(NUM_WORKERS):
+        pool.submit(os.getpid)
+    return pool
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start the HOMR worker pool with the server and stop it on shutdown."""
+    global _pool
+    _pool = _start_pool()
+    yield
+    _pool.shutdown(cancel_futures=True)
+
+
+# Digests of images that were being recognized when a worker died, most recent
+# last. Any of them may be what crashed it, so they aren't run again.
+_CRASHED_DIGESTS_SIZE = 64
+_crashed_digests: "OrderedDict[bytes, None]" = OrderedDict()
+
+_CRASH_RESULT = ("", DEFAULT_TEMPO, {}, [], ["Processing error: the recognition worker crashed"])
+
+
+def _replace_pool(pool: ProcessPoolExecutor) -> None:
+    """Replace a broken pool, unless another request already has."""
+    global _pool
+    if _pool is pool:
+        print("[DEBUG] HOMR worker pool broke, restarting it")
+        pool.shutdown(wait=False, cancel_futures=True)
+        _pool = _start_pool()
+
+
+async def _run_in_pool(image_path: str, digest: bytes) -> Tuple[str, int, dict, List[str], List[str]]:
+    """
+    Run process_sheet_music_file in the worker pool.
+
+    A worker that dies (OOM, crash in ORT) breaks the whole pool, so the pool
+    is replaced. A request that only found the pool already broken is retried
+    on the new one; images that were in flight when it broke are not resent,
+    since any of them may crash the new pool too.
+    """
+    if digest in _crashed_digests:
+        return _CRASH_RESULT
+    for _ in range(2):
+        pool = _pool
+        try:
+            future = pool.submit(process_sheet_music_file, image_path)
+        except BrokenProcessPool:
+            _replace_pool(pool)
+            continue
+        try:
+            return await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            _replace_pool(pool)
+            _crashed_digests[digest] = None
+            _crashed_digests.move_to_end(digest)
+            while len(_crashed_digests) > _CRASHED_DIGESTS_SIZE:
+                _crashed_digests.popitem(last=False)
+            break
+    return _CRASH_RESULT
 
-app = FastAPI(title="Sheet Music Tool API")
+
+# orjson encodes the (often large) MusicXML string much faster than the stdlib json
+app = FastAPI(
+    title="Sheet Music Tool API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 # CORS for frontend
 app.add_middleware(
@@ -18,6 +138,8 @@ app.add_middleware(
 )
 
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB
+MAX_BATCH_FILES = 20
 ALLOWED_TYPES = ["image/png", "image/jpeg", "image/jpg"]
 
 
@@ -31,40 +153,89 @@ class ProcessResponse(BaseModel):
     metadata: Dict[str, Any] = {}  # Title, composer, tempo_text, time/key signatures
 
 
-@app.post("/process", response_model=ProcessResponse)
-async def process_image(file: UploadFile = File(...)):
-    """
-    Process an uploaded sheet music image and return MusicXML.
-    """
-    # Validate file type
+class BatchProcessResponse(BaseModel):
+    results: List[ProcessResponse]  # One per uploaded page, in upload order
+    processing_time: float
+
+
+def _validate_type(file: UploadFile) -> None:
+    """Reject uploads that aren't PNG/JPG images."""
     if file.content_type not in ALLOWED_TYPES:
         raise HTTPException(
             status_code=400,
             detail=f"Invalid file type. Allowed: PNG, JPG. Got: {file.content_type}"
         )
 
-    # Read file content
-    content = await file.read()
 
-    # Validate file size
-    if len(content) > MAX_FILE_SIZE:
-        raise HTTPException(
-            status_code=400,
-            detail=f"File too large. Maximum size: 50MB. Got: {len(content) / 1024 / 1024:.1f}MB"
-        )
+def _file_too_large(size: int) -> HTTPException:
+    return HTTPException(
+        status_code=400,
+        detail=f"File too large. Maximum size: 50MB. Got: {size / 1024 / 1024:.1f}MB"
+    )
+
 
-    # Process the image
+def _validate_size(file: UploadFile) -> None:
+    """Reject uploads whose declared size is already over the limit."""
+    if file.size is not None and file.size > MAX_FILE_SIZE:
+        raise _file_too_large(file.size)
+
+
+async def _save_upload(file: UploadFile) -> Tuple[str, bytes]:
+    """
+    Stream an upload straight into the file HOMR will read, a chunk at a time,
+    hashing it on the way.
+
+    Returns the image path and the image digest; the caller must remove the
+    path's directory.
+    """
+    _validate_size(file)
+    image_path = create_upload_path(file.filename, file.size or 0)
+    try:
+        return image_path, await _write_upload(file, image_path)
+    except BaseException as e:
+        _remove_upload(image_path)
+        if not (isinstance(e, OSError) and e.errno == errno.ENOSPC):
+            raise
+    # The tmpfs temp root filled up mid-write; start again on disk
+    await file.seek(0)
+    image_path = create_upload_path(file.filename, on_disk=True)
+    try:
+        return image_path, await _write_upload(file, image_path)
+    except BaseException:
+        _remove_upload(image_path)
+        raise
+
+
+async def _write_upload(file: UploadFile, image_path: str) -> bytes:
+    """Write an upload to image_path in chunks and return its digest."""
+    hasher = image_hasher()
+    size = 0
+    with open(image_path, 'wb') as f:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            # Validate file size
+            if size > MAX_FILE_SIZE:
+                raise _file_too_large(file.size or size)
+            hasher.update(chunk)
+            f.write(chunk)
+    return hasher.digest()
+
+
+def _remove_upload(image_path: str) -> None:
+    """Delete an upload's temp directory, along with HOMR's output in it."""
+    shutil.rmtree(os.path.dirname(image_path), ignore_errors=True)
+
+
+async def _process_saved_image(image_path: str, digest: bytes) -> ProcessResponse:
+    """Run HOMR on a saved image in the worker pool, unless it was seen recently."""
     start_time = time.time()
-    musicxml, warnings, errors = process_sheet_music(content, file.filename)
+    result = get_cached_result(digest)
+    if result is None:
+        result = await _run_in_pool(image_path, digest)
+        cache_result(digest, result)
+    musicxml, tempo, metadata, warnings, errors = result
     processing_time = time.time() - start_time
 
-    # Extract tempo and metadata from MusicXML
-    tempo = 120
-    metadata = {}
-    if musicxml:
-        tempo = extract_tempo_from_musicxml(musicxml)
-        metadata = extract_metadata_from_musicxml(musicxml)
-
     success = bool(musicxml) and len(errors) == 0
 
     return ProcessResponse(
@@ -78,6 +249,70 @@ async def process_image(file: UploadFile = File(...)):
     )
 
 
+@app.post("/process", response_model=ProcessResponse)
+async def process_image(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+    """
+    Process an uploaded sheet music image and return MusicXML.
+    """
+    _validate_type(file)
+
+    image_path, digest = await _save_upload(file)
+    try:
+        response = await _process_saved_image(image_path, digest)
+    except BaseException:
+        _remove_upload(image_path)
+        raise
+
+    # Delete the temp files after the response has been sent
+    background_tasks.add_task(_remove_upload, image_path)
+    return response
+
+
+@app.post("/process_batch", response_model=BatchProcessResponse)
+async def process_images(files: List[UploadFile] = File(...)):
+    """
+    Process several uploaded pages (e.g. a multi-page score) in one request.
+
+    Pages are spread across the HOMR worker pool, so up to NUM_WORKERS pages
+    are recognized at once. Each page gets its own result, in upload order.
+    """
+    if len(files) > MAX_BATCH_FILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many files. Maximum: {MAX_BATCH_FILES}. Got: {len(files)}"
+        )
+    for file in files:
+        _validate_type(file)
+        _validate_size(file)
+
+    start_time = time.time()
+    # Save each page only when a worker is free for it, so at most NUM_WORKERS
+    # pages sit in the temp root at once rather than the whole batch
+    slots = asyncio.Semaphore(NUM_WORKERS)
+
+    async def process_page(file: UploadFile) -> ProcessResponse:
+        async with slots:
+            image_path, digest = await _save_upload(file)
+            try:
+                return await _process_saved_image(image_path, digest)
+            finally:
+                # Off the event loop, but before the slot goes to the next page
+                await asyncio.to_thread(_remove_upload, image_path)
+
+    tasks = [asyncio.ensure_future(process_page(file)) for file in files]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        # One page failed (e.g. too large once streamed): don't leave the rest
+        # holding workers after the error response
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    return BatchProcessResponse(results=results, processing_time=time.time() - start_time)
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""